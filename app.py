@@ -9,16 +9,29 @@ GitHub: https://github.com/ahmertsengol
 
 from flask import Flask, render_template, request, send_file, jsonify
 import os
-import json
-import math
-import numpy as np
-import mediapipe as mp
-import skimage
-from skimage.transform import PiecewiseAffineTransform, warp
+import io
 import tempfile
+import gzip
+import hashlib
+import threading
+import queue
+import time
+from contextlib import contextmanager
+from functools import wraps, lru_cache
+import numpy as np
 from werkzeug.utils import secure_filename
 import warnings
 
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip variants are always written
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: coalescing and pins are then per process only
+    fcntl = None
+
 warnings.filterwarnings('ignore')
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
@@ -27,6 +40,14 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['RESULTS_FOLDER'] = 'results'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
+app.config['ALIGN_MODE'] = os.environ.get('ALIGN_MODE', 'grid')  # 'grid' or 'procrustes'
+app.config['WARMUP_IMAGE'] = 'examples/gakki.jpg'
+# Retention of uploads/ and results/: artifacts older than the TTL, or the oldest
+# ones while a folder is over its quota, are deleted by a background sweeper
+app.config['RETENTION_TTL'] = int(os.environ.get('RETENTION_TTL', 24 * 3600))  # seconds
+app.config['RETENTION_INTERVAL'] = int(os.environ.get('RETENTION_INTERVAL', 60))  # seconds
+app.config['UPLOADS_MAX_BYTES'] = int(os.environ.get('UPLOADS_MAX_BYTES', 1024 ** 3))
+app.config['RESULTS_MAX_BYTES'] = int(os.environ.get('RESULTS_MAX_BYTES', 2 * 1024 ** 3))
 
 # Create necessary directories
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -34,89 +55,326 @@ os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
 
 # Import functions from simplified_mp_to_obj
 from simplified_mp_to_obj import (
-    load_obj,
+    LANDMARK_FORMATS,
+    load_uv_map,
+    load_canonical_model,
+    load_image,
+    create_face_mesh,
+    detect_landmarks,
+    landmarks_to_pixels,
+    landmarks_to_keypoints3d,
+    bake_texture,
+    align_vertices,
+    DEFAULT_RIGID_WEIGHT,
+    encode_landmarks,
     write_obj,
-    normalize_keypoints,
-    align_keypoints_to_grid
+    write_material
 )
+from retention import Retention, RetentionPolicy
+
+# Weight of the rigid landmarks in the 'procrustes' alignment (1 = unweighted)
+app.config['RIGID_WEIGHT'] = float(os.environ.get('RIGID_WEIGHT', DEFAULT_RIGID_WEIGHT))
+
+# Precompressed variants of the text artifacts, in order of preference
+PRECOMPRESSED = [('br', '.br'), ('gzip', '.gz')]
+
+# output name -> lock held while its texture is being baked or a re-upload
+# replaces it, so concurrent first requests for the same texture/MTL wait for
+# one computation. Across worker processes the same is done with an flock on
+# <name>_landmarks.npz (see material_lock)
+_material_locks = {}
+_material_locks_guard = threading.Lock()
+
+# Idle FaceMesh instances. Each is used by one request at a time and returned
+# afterwards, so the graph is initialized once per concurrent request instead of per upload
+_face_meshes = queue.LifoQueue()
+
+warmup_state = {'ready': False, 'seconds': None, 'error': None}
+
+# Suffixes of the files written for one upload in results/, longest first
+RESULT_SUFFIXES = ['_landmarks.tmp.npz', '_texture.tmp.jpg',
+                   '.obj.gz.tmp', '.obj.br.tmp', '.mtl.gz.tmp', '.mtl.br.tmp',
+                   '_landmarks.npz', '_texture.jpg', '.obj.gz', '.obj.br',
+                   '.mtl.gz', '.mtl.br', '.mtl.tmp', '.obj', '.mtl']
+
+def result_artifact_key(name):
+    """The output name a file in results/ belongs to"""
+    for suffix in RESULT_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def upload_artifact_key(name):
+    """The output name an uploaded image is converted to"""
+    return os.path.splitext(name)[0]
+
+# An upload and its results are one artifact: the lazy texture bake needs the
+# uploaded image, so it is only ever evicted together with the results
+retention = Retention([
+    RetentionPolicy(app.config['UPLOAD_FOLDER'],
+                    ttl_seconds=app.config['RETENTION_TTL'],
+                    max_bytes=app.config['UPLOADS_MAX_BYTES'],
+                    artifact_key=upload_artifact_key,
+                    linked_folders=[app.config['RESULTS_FOLDER']]),
+    RetentionPolicy(app.config['RESULTS_FOLDER'],
+                    ttl_seconds=app.config['RETENTION_TTL'],
+                    max_bytes=app.config['RESULTS_MAX_BYTES'],
+                    artifact_key=result_artifact_key,
+                    linked_folders=[app.config['UPLOAD_FOLDER']]),
+], interval=app.config['RETENTION_INTERVAL'])
+
+def pin_result(view):
+    """Keeps the retention sweeper away from a result while it is being served"""
+    @wraps(view)
+    def wrapper(filename):
+        paths = result_paths(filename)
+        if not (os.path.exists(paths['obj']) or os.path.exists(paths['landmarks'])):
+            # Nothing to protect (the view answers 404); don't leave a pin file behind
+            return view(filename)
+        with retention.pin(app.config['RESULTS_FOLDER'], filename):
+            return view(filename)
+    return wrapper
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def precompress(path):
+    """Write gzip (and brotli, if installed) variants next to a text artifact"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, mode=brotli.MODE_TEXT)))
+    for suffix, compressed in variants:
+        # Moved into place so another worker never serves a partial variant
+        with open(path + suffix + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(path + suffix + '.tmp', path + suffix)
+
+@lru_cache(maxsize=1024)
+def _file_hash(path, mtime_ns, size):
+    # Keyed on (path, mtime_ns, size) so each version of a file is hashed once;
+    # bounded, so deleted and replaced files age out
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+def content_etag(path):
+    """Strong ETag derived from the file content"""
+    stat = os.stat(path)
+    return _file_hash(path, stat.st_mtime_ns, stat.st_size)
+
+def send_artifact(path, mimetype=None, download_name=None):
+    """send_file with content ETags, If-None-Match/Range handling and precompressed variants"""
+    served_path, encoding = path, None
+    for name, suffix in PRECOMPRESSED:
+        variant = path + suffix
+        # A variant older than the file is left over from a previous upload with the same name
+        if (request.accept_encodings[name] and os.path.exists(variant)
+                and os.path.getmtime(variant) >= os.path.getmtime(path)):
+            served_path, encoding = variant, name
+            break
+
+    response = send_file(served_path,
+                         mimetype=mimetype,
+                         as_attachment=download_name is not None,
+                         download_name=download_name,
+                         etag=content_etag(served_path),
+                         conditional=True)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Output names are reused across uploads, so always revalidate
+    response.cache_control.no_cache = True
+    return response
+
+@contextmanager
+def pooled_face_mesh():
+    try:
+        face_mesh = _face_meshes.get_nowait()
+    except queue.Empty:
+        face_mesh = create_face_mesh()
+    try:
+        yield face_mesh
+    finally:
+        _face_meshes.put(face_mesh)
+
+def warmup():
+    """Load every asset and run one detection and texture bake on a bundled image"""
+    start = time.perf_counter()
+    try:
+        uv_map = load_uv_map()
+        canonical_verts = load_canonical_model()[0]
+        img = load_image(app.config['WARMUP_IMAGE'])
+        H, W, _ = img.shape
+        with pooled_face_mesh() as face_mesh:
+            landmarks = detect_landmarks(img, face_mesh)
+        bake_texture(img, landmarks_to_pixels(landmarks, W, H), uv_map)
+        align_vertices(landmarks_to_keypoints3d(landmarks, W, H), canonical_verts,
+                              app.config['ALIGN_MODE'], app.config['RIGID_WEIGHT'])
+    except Exception as e:
+        warmup_state['error'] = str(e)
+        print(f"❌ Warmup failed: {e}")
+        return
+    warmup_state['seconds'] = time.perf_counter() - start
+    warmup_state['ready'] = True
+    print(f"✅ Warmup completed in {warmup_state['seconds']:.2f}s")
+
+def start_warmup():
+    """Warm up in the background; /readyz reports ready once it is done"""
+    thread = threading.Thread(target=warmup, name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+def result_paths(output_name):
+    """Paths of the artifacts produced for one upload"""
+    base = os.path.join(app.config['RESULTS_FOLDER'], output_name)
+    return {
+        'obj': f"{base}.obj",
+        'mtl': f"{base}.mtl",
+        'texture': f"{base}_texture.jpg",
+        'landmarks': f"{base}_landmarks.npz",
+    }
+
 def process_image(img_path, output_name="output"):
-    """Process image and generate OBJ files"""
-    uv_path = "data/uv_map.json"
-    uv_map_dict = json.load(open(uv_path))
-    uv_map = np.array([(uv_map_dict["u"][str(i)], uv_map_dict["v"][str(i)]) for i in range(468)])
-    
-    img_ori = skimage.io.imread(img_path)
-    
-    # Handle RGBA images
-    if len(img_ori.shape) == 3 and img_ori.shape[2] == 4:
-        img_ori = skimage.color.rgba2rgb(img_ori)
-        img_ori = (img_ori * 255).astype(np.uint8)
-    
-    img = img_ori
+    """Process image and generate the OBJ file.
+
+    The texture and MTL are not baked here: the landmarks are stored next to
+    the OBJ together with the source image path, and ensure_material()
+    produces them on the first request that needs them.
+    """
+    img = load_image(img_path)
     H, W, _ = img.shape
     
     # Run facial landmark detection
-    with mp.solutions.face_mesh.FaceMesh(
-            static_image_mode=True,
-            refine_landmarks=True,
-            max_num_faces=1,
-            min_detection_confidence=0.5) as face_mesh:
-        try:
-            results = face_mesh.process(img)
-        except ValueError:
-            # PNG conversion if needed
-            tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'converted.jpg')
-            png_img = skimage.io.imread(img_path)
-            rgb_img = skimage.color.rgba2rgb(png_img)
-            skimage.io.imsave(tmp_path, rgb_img, quality=100)
-            img = skimage.io.imread(tmp_path)
-            results = face_mesh.process(img)
-    
-    if not results.multi_face_landmarks:
-        raise Exception("No face detected in the image.")
-    
-    face_landmarks = results.multi_face_landmarks[0]
-    keypoints = np.array([(W*point.x, H*point.y) for point in face_landmarks.landmark[0:468]])
-    
-    # Generate texture
-    H_new, W_new = 512, 512
-    keypoints_uv = np.array([(W_new*x, H_new*y) for x, y in uv_map])
-    
-    tform = PiecewiseAffineTransform()
-    tform.estimate(keypoints_uv, keypoints)
-    texture = warp(img_ori, tform, output_shape=(H_new, W_new))
-    texture = (255*texture).astype(np.uint8)
-    
-    # Get 3D keypoints
-    width_ratio = W / H
-    keypoints3d = np.array([(width_ratio * point.x, point.y, width_ratio * point.z) 
-                           for point in face_landmarks.landmark[0:468]])
+    with pooled_face_mesh() as face_mesh:
+        landmarks = detect_landmarks(img, face_mesh)
     
     # Load canonical face model
-    obj_filename = "./data/canonical_face_model.obj"
-    canonical_verts, uvcoords, faces, uv_faces = load_obj(obj_filename)
+    canonical_verts, uvcoords, faces, uv_faces = load_canonical_model()
     
     # Normalize and align
-    vertices = normalize_keypoints(keypoints3d)
-    vertices = align_keypoints_to_grid(vertices)
+    vertices = align_vertices(landmarks_to_keypoints3d(landmarks, W, H), canonical_verts,
+                              app.config['ALIGN_MODE'], app.config['RIGID_WEIGHT'])
     
     # Save files
-    obj_name = os.path.join(app.config['RESULTS_FOLDER'], f"{output_name}.obj")
-    texture_name = os.path.join(app.config['RESULTS_FOLDER'], f"{output_name}_texture.jpg")
+    paths = result_paths(output_name)
+    
+    with material_lock(output_name):
+        # Drop the material of a previous upload with the same name. A bake of
+        # it that was running has finished by now, and later ones see the new landmarks
+        for path in (paths['mtl'], paths['mtl'] + '.gz', paths['mtl'] + '.br', paths['texture']):
+            if os.path.exists(path):
+                os.remove(path)
+        tmp_path = paths['landmarks'][:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, landmarks=landmarks, source=os.path.abspath(img_path))
+        os.replace(tmp_path, paths['landmarks'])
     
-    write_obj(obj_name, vertices, faces, texture_name, 
-             texture=texture, uvcoords=uvcoords, uvfaces=uv_faces)
+    write_obj(paths['obj'], vertices, faces, paths['texture'],
+             uvcoords=uvcoords, uvfaces=uv_faces, lazy_texture=True)
+    precompress(paths['obj'])
     
-    return obj_name, texture_name
+    return paths['obj'], paths['texture']
+
+@contextmanager
+def material_lock(output_name):
+    """Serializes baking and replacing the material of an upload: the per-name
+    thread lock, plus an flock on its landmarks file for other worker processes.
+    Yields the locked landmarks file, or None if there is none"""
+    path = result_paths(output_name)['landmarks']
+    with _material_locks_guard:
+        lock = _material_locks.setdefault(output_name, threading.Lock())
+    try:
+        with lock:
+            while True:
+                try:
+                    stored_file = open(path, 'rb')
+                except FileNotFoundError:
+                    yield None
+                    return
+                with stored_file:
+                    if fcntl is None:
+                        yield stored_file
+                        return
+                    fcntl.flock(stored_file, fcntl.LOCK_EX)
+                    # A re-upload may have replaced the file while we waited
+                    try:
+                        current = os.stat(path).st_ino == os.fstat(stored_file.fileno()).st_ino
+                    except FileNotFoundError:
+                        current = False
+                    if current:
+                        yield stored_file
+                        return
+    finally:
+        with _material_locks_guard:
+            if _material_locks.get(output_name) is lock:
+                del _material_locks[output_name]
+
+def ensure_material(output_name):
+    """Bake the texture and MTL of an upload if they don't exist yet.
+
+    Returns False when there is nothing to bake from (unknown name or the
+    source image is gone).
+    """
+    paths = result_paths(output_name)
+    # The MTL is written last, so it existing means the texture is complete
+    def baked():
+        return os.path.exists(paths['mtl']) and os.path.exists(paths['texture'])
+    if baked():
+        return True
+    
+    # Concurrent first requests, in this or other worker processes, wait here
+    with material_lock(output_name) as stored_file:
+        if stored_file is None:
+            return False
+        if baked():
+            return True
+        with np.load(stored_file) as stored:
+            landmarks = stored['landmarks']
+            source = str(stored['source'])
+        with retention.pin(app.config['UPLOAD_FOLDER'], upload_artifact_key(os.path.basename(source))):
+            if not os.path.exists(source):
+                return False
+            img = load_image(source)
+        
+        H, W, _ = img.shape
+        texture = bake_texture(img, landmarks_to_pixels(landmarks, W, H), load_uv_map())
+        
+        write_material(paths['mtl'], paths['texture'], texture)
+        precompress(paths['mtl'])
+        return True
+
+def process_landmarks(img_file):
+    """Detect and align landmarks only, without texture baking or writing files"""
+    img = load_image(img_file)
+    H, W, _ = img.shape
+    with pooled_face_mesh() as face_mesh:
+        landmarks = detect_landmarks(img, face_mesh)
+    canonical_verts, _, _, _ = load_canonical_model()
+    vertices = align_vertices(landmarks_to_keypoints3d(landmarks, W, H), canonical_verts,
+                              app.config['ALIGN_MODE'], app.config['RIGID_WEIGHT'])
+    return landmarks, vertices
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    if warmup_state['ready']:
+        return jsonify({'ready': True, 'warmup_seconds': warmup_state['seconds']})
+    return jsonify({'ready': False, 'error': warmup_state['error']}), 503
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({'retention': retention.metrics(), 'warmup': warmup_state})
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -129,13 +387,15 @@ def upload_file():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
         
         # Generate output name
         output_name = os.path.splitext(filename)[0]
         
         try:
-            obj_path, texture_path = process_image(filepath, output_name)
+            with retention.pin(app.config['UPLOAD_FOLDER'], output_name), \
+                    retention.pin(app.config['RESULTS_FOLDER'], output_name):
+                file.save(filepath)
+                obj_path, texture_path = process_image(filepath, output_name)
             
             return jsonify({
                 'success': True,
@@ -149,54 +409,99 @@ def upload_file():
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+@app.route('/landmarks', methods=['POST'])
+def landmarks():
+    """Raw and aligned (468, 3) vertices only, as json, npy or f32 (?format=)"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file type'}), 400
+    
+    fmt = request.values.get('format', 'json')
+    if fmt not in LANDMARK_FORMATS:
+        return jsonify({'error': f'Unknown format: {fmt}'}), 400
+    
+    try:
+        raw, aligned = process_landmarks(io.BytesIO(file.read()))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    response = app.response_class(encode_landmarks(raw, aligned, fmt),
+                                  mimetype=LANDMARK_FORMATS[fmt][1])
+    if fmt == 'f32':
+        response.headers['X-Array-Shape'] = '2,468,3'
+        response.headers['X-Array-Dtype'] = '<f4'
+    return response
+
 @app.route('/download/obj/<filename>')
+@pin_result
 def download_obj(filename):
     obj_path = os.path.join(app.config['RESULTS_FOLDER'], f"{filename}.obj")
     if os.path.exists(obj_path):
         # Check if it's a preview request
         if request.args.get('preview') == 'true':
-            return send_file(obj_path, mimetype='text/plain')
-        return send_file(obj_path, as_attachment=True, download_name=f"{filename}.obj")
+            return send_artifact(obj_path, mimetype='text/plain')
+        return send_artifact(obj_path, download_name=f"{filename}.obj")
     return jsonify({'error': 'File not found'}), 404
 
 @app.route('/download/texture/<filename>')
+@pin_result
 def download_texture(filename):
     texture_path = os.path.join(app.config['RESULTS_FOLDER'], f"{filename}_texture.jpg")
-    if os.path.exists(texture_path):
+    if ensure_material(filename):
         # Check if it's a download request or preview
         if request.args.get('preview') == 'true':
-            return send_file(texture_path, mimetype='image/jpeg')
-        return send_file(texture_path, as_attachment=True, download_name=f"{filename}_texture.jpg")
+            return send_artifact(texture_path, mimetype='image/jpeg')
+        return send_artifact(texture_path, download_name=f"{filename}_texture.jpg")
     return jsonify({'error': 'File not found'}), 404
 
 @app.route('/download/mtl/<filename>')
+@pin_result
 def download_mtl(filename):
     mtl_path = os.path.join(app.config['RESULTS_FOLDER'], f"{filename}.mtl")
-    if os.path.exists(mtl_path):
+    if ensure_material(filename):
         # Check if it's a preview request
         if request.args.get('preview') == 'true':
-            return send_file(mtl_path, mimetype='text/plain')
-        return send_file(mtl_path, as_attachment=True, download_name=f"{filename}.mtl")
+            return send_artifact(mtl_path, mimetype='text/plain')
+        return send_artifact(mtl_path, download_name=f"{filename}.mtl")
     return jsonify({'error': 'File not found'}), 404
 
+def serve(port, host='0.0.0.0'):
+    """Production server: waitress if installed, otherwise Flask's threaded server"""
+    start_warmup()
+    retention.start()
+    if os.environ.get('FLASK_DEBUG') == '1':
+        app.run(debug=True, host=host, port=port, use_reloader=False)
+        return
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        app.run(host=host, port=port, threaded=True)
+        return
+    waitress_serve(app, host=host, port=port, threads=int(os.environ.get('THREADS', 8)))
+
 if __name__ == '__main__':
     import socket
     
-    # Port kontrolü - önce 5000'i dene, yoksa 8080 kullan
-    port = 5000
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex(('127.0.0.1', 5000))
-    sock.close()
-    
-    if result == 0:
-        # Port 5000 kullanımda, 8080 kullan
-        port = 8080
-        print("⚠️  Port 5000 kullanımda (muhtemelen macOS AirPlay), port 8080 kullanılıyor...")
-        print("💡 macOS'ta AirPlay'i kapatmak için: Sistem Ayarları > Genel > AirDrop ve Handoff > AirPlay Alıcı")
+    if 'PORT' in os.environ:
+        port = int(os.environ['PORT'])
     else:
-        port = int(os.environ.get('PORT', 5000))
+        # Port kontrolü - önce 5000'i dene, yoksa 8080 kullan
+        port = 5000
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        result = sock.connect_ex(('127.0.0.1', 5000))
+        sock.close()
+        
+        if result == 0:
+            # Port 5000 kullanımda, 8080 kullan
+            port = 8080
+            print("⚠️  Port 5000 kullanımda (muhtemelen macOS AirPlay), port 8080 kullanılıyor...")
+            print("💡 macOS'ta AirPlay'i kapatmak için: Sistem Ayarları > Genel > AirDrop ve Handoff > AirPlay Alıcı")
     
     print(f"🚀 Server starting on http://localhost:{port}")
     print(f"📝 Tarayıcınızda http://localhost:{port} adresini açın")
-    app.run(debug=True, host='0.0.0.0', port=port)
-
+    serve(port)
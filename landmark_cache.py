@@ -0,0 +1,110 @@
+"""
+On-disk cache of face landmark detections
+
+Entries are keyed by the hash of the image file content and the detector
+settings, so re-exporting the same image (new output name, format, texture
+size, alignment...) can skip MediaPipe detection. Each entry is a small .npz
+holding the raw normalized landmarks, the image size and the detector
+settings. The cache is trimmed to a maximum entry count and total size,
+dropping the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = '.landmark_cache'
+# Bump when the stored layout changes so old entries are ignored
+CACHE_VERSION = 1
+
+
+class LandmarkCache:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(image_bytes, params):
+        digest = hashlib.sha256()
+        digest.update(b'v%d\0' % CACHE_VERSION)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        digest.update(b'\0')
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """Returns (landmarks, (H, W)) for a cached detection, or None"""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                landmarks = entry['landmarks']
+                size = tuple(int(v) for v in entry['image_size'])
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # Corrupted (e.g. truncated) entry: drop it and treat it as a miss
+            self.invalidate(key)
+            return None
+        try:
+            # Mark as recently used for the LRU trimming
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # Trimmed or invalidated meanwhile, the data is still good
+        return landmarks, size
+
+    def put(self, key, landmarks, image_size, params):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 landmarks=landmarks,
+                 image_size=np.array(image_size),
+                 params=json.dumps(params, sort_keys=True))
+        os.replace(tmp_path, path)
+        self.trim()
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            os.remove(path)
+
+    def _entries(self):
+        """(path, size, mtime) of every entry, oldest first"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def trim(self):
+        """Drop least recently used entries until within max_entries and max_bytes"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            path, size, _ = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
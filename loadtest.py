@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Load generator for the Flask web interface
+
+Starts app.py locally (or targets --url), replays uploads of the example images
+against /upload and the /download/* routes, and reports throughput, latency
+percentiles, error rates and server memory over time. Results are saved as JSON
+so two runs (e.g. two versions of the app) can be compared with --compare.
+
+Only the standard library is used, so it runs offline next to the app.
+"""
+
+import argparse
+import glob
+import json
+import math
+import mimetypes
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_local_server(port):
+    """Run app.py with its production server on <port> in a child process"""
+    env = dict(os.environ, PORT=str(port))
+    return subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(base_url, proc=None, timeout=120):
+    """Waits for /readyz, or for / on versions of the app without it"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError("Server exited with code %d during startup" % proc.returncode)
+        status, _, _ = timed_request(base_url + '/readyz', timeout=2)
+        if status == 200:
+            return
+        if status == 404:
+            status, _, _ = timed_request(base_url + '/', timeout=2)
+            if status == 200:
+                return
+        time.sleep(0.25)
+    raise RuntimeError("Server at %s did not become ready within %ds" % (base_url, timeout))
+
+
+def read_rss(pid):
+    """Resident set size of <pid> in bytes, or None if it can't be read"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        out = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)],
+                             capture_output=True, text=True, check=True).stdout
+        return int(out.strip()) * 1024
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def multipart_body(field, filename, content):
+    boundary = uuid.uuid4().hex
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    body = b''.join([
+        ('--%s\r\n' % boundary).encode(),
+        ('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (field, filename)).encode(),
+        ('Content-Type: %s\r\n\r\n' % mimetype).encode(),
+        content,
+        ('\r\n--%s--\r\n' % boundary).encode(),
+    ])
+    return body, 'multipart/form-data; boundary=%s' % boundary
+
+
+def timed_request(req, timeout):
+    """Returns (status, body, seconds). Network failures are reported as status 0"""
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        status = e.code
+    except (urllib.error.URLError, ConnectionError, socket.timeout, OSError):
+        body = b''
+        status = 0
+    return status, body, time.perf_counter() - start
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * q / 100.0
+    lo, hi = math.floor(k), math.ceil(k)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class LoadTest:
+
+    def __init__(self, base_url, images, concurrency=4, rate=0.0, duration=30.0,
+                 requests=None, downloads=True, timeout=120.0, server_pid=None):
+        self.base_url = base_url.rstrip('/')
+        self.images = []
+        for path in images:
+            with open(path, 'rb') as f:
+                self.images.append((os.path.basename(path), f.read()))
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.max_requests = requests
+        self.downloads = downloads
+        self.timeout = timeout
+        self.server_pid = server_pid
+
+        self.samples = []  # (route, start offset, seconds, status)
+        self.rss = []  # (offset, bytes)
+        self._lock = threading.Lock()
+        self._issued = 0
+        self._stop = threading.Event()
+
+    def _next_slot(self):
+        # Open-loop pacing: iteration i is due at t0 + i / rate, whoever picks it up
+        with self._lock:
+            if self.max_requests is not None and self._issued >= self.max_requests:
+                return None
+            i = self._issued
+            self._issued += 1
+        due = self.t0 + (i / self.rate if self.rate > 0 else 0)
+        if self.max_requests is None and max(due, time.perf_counter()) - self.t0 >= self.duration:
+            return None
+        return i, due
+
+    def _record(self, route, start, seconds, status):
+        with self._lock:
+            self.samples.append((route, start - self.t0, seconds, status))
+
+    def _iteration(self, i):
+        name, content = self.images[i % len(self.images)]
+        # Unique names keep concurrent conversions from overwriting each other's results
+        filename = 'loadtest_%d_%s' % (i, name)
+        body, content_type = multipart_body('file', filename, content)
+        req = urllib.request.Request(self.base_url + '/upload', data=body, method='POST',
+                                     headers={'Content-Type': content_type})
+        start = time.perf_counter()
+        status, resp_body, seconds = timed_request(req, self.timeout)
+        self._record('/upload', start, seconds, status)
+        if status != 200 or not self.downloads:
+            return
+        try:
+            links = json.loads(resp_body)
+        except ValueError:
+            return
+        for key, route in (('obj_file', '/download/obj'),
+                           ('mtl_file', '/download/mtl'),
+                           ('texture_file', '/download/texture')):
+            if key not in links:
+                continue
+            start = time.perf_counter()
+            status, _, seconds = timed_request(self.base_url + links[key], self.timeout)
+            self._record(route, start, seconds, status)
+
+    def _worker(self):
+        while not self._stop.is_set():
+            slot = self._next_slot()
+            if slot is None:
+                return
+            i, due = slot
+            delay = due - time.perf_counter()
+            if delay > 0 and self._stop.wait(delay):
+                return
+            self._iteration(i)
+
+    def _sample_rss(self, interval):
+        while not self._stop.wait(interval):
+            rss = read_rss(self.server_pid)
+            if rss is not None:
+                self.rss.append((time.perf_counter() - self.t0, rss))
+
+    def run(self, rss_interval=0.5):
+        self.t0 = time.perf_counter()
+        workers = [threading.Thread(target=self._worker, daemon=True)
+                   for _ in range(self.concurrency)]
+        sampler = None
+        if self.server_pid is not None:
+            sampler = threading.Thread(target=self._sample_rss, args=(rss_interval,), daemon=True)
+            sampler.start()
+        for w in workers:
+            w.start()
+        try:
+            for w in workers:
+                w.join()
+        except KeyboardInterrupt:
+            self._stop.set()
+            for w in workers:
+                w.join()
+        self.elapsed = time.perf_counter() - self.t0
+        self._stop.set()
+        if sampler is not None:
+            sampler.join()
+        return self.summary()
+
+    def summary(self):
+        routes = {}
+        for route in sorted({s[0] for s in self.samples}):
+            rows = [s for s in self.samples if s[0] == route]
+            latencies = sorted(s[2] for s in rows)
+            errors = sum(1 for s in rows if s[3] != 200)
+            routes[route] = {
+                'requests': len(rows),
+                'errors': errors,
+                'error_rate': errors / len(rows),
+                'throughput_rps': len(rows) / self.elapsed,
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p95_ms': 1000 * percentile(latencies, 95),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'max_ms': 1000 * latencies[-1],
+            }
+
+        # Per-second buckets of completed requests and errors, per route, for the "over time" view
+        timeline = {}
+        for route, start, seconds, status in self.samples:
+            bucket = timeline.setdefault(int(start + seconds), {}).setdefault(
+                route, {'completed': 0, 'errors': 0})
+            bucket['completed'] += 1
+            bucket['errors'] += status != 200
+        rss_values = [r for _, r in self.rss]
+        return {
+            'base_url': self.base_url,
+            'config': {
+                'concurrency': self.concurrency,
+                'rate': self.rate,
+                'duration': self.duration,
+                'requests': self.max_requests,
+                'downloads': self.downloads,
+                'images': [name for name, _ in self.images],
+            },
+            'elapsed_s': self.elapsed,
+            'iterations': sum(1 for s in self.samples if s[0] == '/upload'),
+            'routes': routes,
+            'timeline': [{'second': k, 'routes': v} for k, v in sorted(timeline.items())],
+            'rss': {
+                'samples': [{'t': round(t, 3), 'bytes': r} for t, r in self.rss],
+                'start_bytes': rss_values[0] if rss_values else None,
+                'peak_bytes': max(rss_values) if rss_values else None,
+                'end_bytes': rss_values[-1] if rss_values else None,
+            },
+        }
+
+
+def print_report(result, baseline=None):
+    print("Target: %s  concurrency=%d  rate=%s  elapsed=%.1fs  iterations=%d" % (
+        result['base_url'], result['config']['concurrency'],
+        result['config']['rate'] or 'unlimited', result['elapsed_s'], result['iterations']))
+    header = "%-20s %8s %8s %8s %10s %10s %10s" % (
+        'route', 'reqs', 'err%', 'rps', 'p50 ms', 'p95 ms', 'p99 ms')
+    print(header)
+    print('-' * len(header))
+    for route, r in result['routes'].items():
+        print("%-20s %8d %7.1f%% %8.2f %10.1f %10.1f %10.1f" % (
+            route, r['requests'], 100 * r['error_rate'], r['throughput_rps'],
+            r['p50_ms'], r['p95_ms'], r['p99_ms']))
+        if baseline and route in baseline['routes']:
+            b = baseline['routes'][route]
+            print("%-20s %8s %+7.1f%% %+8.2f %+10.1f %+10.1f %+10.1f" % (
+                '  vs baseline', '',
+                100 * (r['error_rate'] - b['error_rate']),
+                r['throughput_rps'] - b['throughput_rps'],
+                r['p50_ms'] - b['p50_ms'], r['p95_ms'] - b['p95_ms'], r['p99_ms'] - b['p99_ms']))
+    rss = result['rss']
+    if rss['peak_bytes'] is not None:
+        mb = 1024 * 1024
+        print("Server RSS: start %.1f MB, peak %.1f MB, end %.1f MB" % (
+            rss['start_bytes'] / mb, rss['peak_bytes'] / mb, rss['end_bytes'] / mb))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="loadtest", description="Load test the face mesh web service")
+    parser.add_argument('--url', help="Target an already running instance instead of starting app.py locally")
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help="Number of concurrent clients")
+    parser.add_argument('-r', '--rate', type=float, default=0.0,
+                        help="Upload iterations started per second across all clients (0 = as fast as possible)")
+    parser.add_argument('-d', '--duration', type=float, default=30.0, help="Seconds to run for")
+    parser.add_argument('-n', '--requests', type=int, help="Stop after this many uploads instead of --duration")
+    parser.add_argument('--images', nargs='+', help="Images to upload. Defaults to examples/*.jpg and *.png")
+    parser.add_argument('--no-downloads', action='store_true', help="Only exercise /upload")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument('--label', default='run', help="Name used for the saved result file")
+    parser.add_argument('--results-dir', default=os.path.join(ROOT, 'loadtest_results'),
+                        help="Where to save the JSON results")
+    parser.add_argument('--compare', help="A previous result JSON to compare against")
+    args = parser.parse_args()
+
+    images = args.images or sorted(glob.glob(os.path.join(ROOT, 'examples', '*.jpg')) +
+                                   glob.glob(os.path.join(ROOT, 'examples', '*.png')))
+    if not images:
+        parser.error("No images to upload")
+
+    proc = None
+    base_url = args.url
+    if base_url is None:
+        port = free_port()
+        base_url = 'http://127.0.0.1:%d' % port
+        proc = start_local_server(port)
+        print("Started local server (pid %d) on %s" % (proc.pid, base_url))
+    try:
+        wait_until_up(base_url, proc)
+        test = LoadTest(base_url, images,
+                        concurrency=args.concurrency,
+                        rate=args.rate,
+                        duration=args.duration,
+                        requests=args.requests,
+                        downloads=not args.no_downloads,
+                        timeout=args.timeout,
+                        server_pid=proc.pid if proc is not None else None)
+        result = test.run()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    result['label'] = args.label
+    result['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    out_path = os.path.join(args.results_dir, '%s-%s.json' % (
+        args.label, time.strftime('%Y%m%d-%H%M%S')))
+    with open(out_path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print("Results saved to %s" % out_path)
+
+
+if __name__ == '__main__':
+    main()
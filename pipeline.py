@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Pipelined batch converter
+
+Runs decode -> detect -> bake -> write as separate stages connected by bounded
+queues, so decoding and writing (disk) overlap with detection and texture
+baking (CPU). Every stage has its own number of worker threads; items are
+plain dicts handed from stage to stage by reference. MediaPipe runs its graph
+in C++, so detection scales on threads. Texture baking does not: scikit-image's
+PiecewiseAffineTransform estimates and applies one affine per triangle in
+Python, holding the GIL. The bake stage's threads therefore hand the work to
+a pool of as many processes; decoded images are placed in shared memory, so
+the bake processes read them without the image being copied or pickled.
+
+Usage:
+    python pipeline.py -i photos/ -o results/batch
+    python pipeline.py -i clip.mp4 -o results/clip --detect-workers 4
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from simplified_mp_to_obj import (
+    load_image,
+    create_face_mesh,
+    detect_landmarks,
+    NoFaceDetected,
+    load_uv_map,
+    load_canonical_model,
+    landmarks_to_pixels,
+    landmarks_to_keypoints3d,
+    bake_texture,
+    align_vertices,
+    DEFAULT_RIGID_WEIGHT,
+    sample_vertex_colors,
+    write_obj,
+    write_ply,
+    non_negative_int,
+)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+# Marks the end of the input on a stage's queue
+_DONE = object()
+
+
+class Stage:
+    """One step of the pipeline: fn(item) returns the item for the next stage, or None to drop it"""
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = []
+        self.busy_seconds = 0.0
+        self.depth_samples = []
+        self._lock = threading.Lock()
+
+    def stats(self, elapsed):
+        depths = self.depth_samples or [0]
+        return {
+            'workers': self.workers,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': len(self.errors),
+            'utilization': self.busy_seconds / (self.workers * elapsed) if elapsed > 0 else 0.0,
+            'queue_depth_mean': sum(depths) / len(depths),
+            'queue_depth_max': max(depths),
+        }
+
+
+class Pipeline:
+
+    def __init__(self, stages, queue_size=8, sample_interval=0.1):
+        for stage in stages:
+            # With no worker nobody would pass the end marker on, and run() would hang
+            if stage.workers < 1:
+                raise ValueError("stage %r needs at least one worker" % stage.name)
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.sample_interval = sample_interval
+        self._remaining = [stage.workers for stage in stages]
+        self._remaining_lock = threading.Lock()
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            failed = False
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                result, failed = None, True
+                with stage._lock:
+                    stage.errors.append((item.get('name'), str(e)))
+            with stage._lock:
+                stage.busy_seconds += time.perf_counter() - start
+                stage.processed += 1
+                if result is None and not failed:
+                    stage.dropped += 1
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+        # The last worker of a stage to finish closes the next stage's queue
+        with self._remaining_lock:
+            self._remaining[index] -= 1
+            last = self._remaining[index] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].workers):
+                outbox.put(_DONE)
+
+    def _sample_depths(self, stop):
+        while not stop.wait(self.sample_interval):
+            for stage, q in zip(self.stages, self.queues):
+                stage.depth_samples.append(q.qsize())
+
+    def run(self, items):
+        """Feeds items through every stage and returns per-stage stats"""
+        start = time.perf_counter()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                t = threading.Thread(target=self._worker, args=(index,),
+                                     name='%s-%d' % (stage.name, n), daemon=True)
+                t.start()
+                threads.append(t)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_depths, args=(stop,), daemon=True)
+        sampler.start()
+
+        # Blocks whenever the first queue is full, so the input is read at the pipeline's pace
+        for item in items:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(_DONE)
+
+        for t in threads:
+            t.join()
+        stop.set()
+        sampler.join()
+        self.elapsed = time.perf_counter() - start
+        return {stage.name: stage.stats(self.elapsed) for stage in self.stages}
+
+
+def print_stats(stats, elapsed):
+    header = "%-8s %8s %10s %8s %7s %12s %10s" % (
+        'stage', 'workers', 'processed', 'dropped', 'errors', 'utilization', 'queue avg/max')
+    print(header)
+    print('-' * len(header))
+    for name, s in stats.items():
+        print("%-8s %8d %10d %8d %7d %11.0f%% %8.1f/%d" % (
+            name, s['workers'], s['processed'], s['dropped'], s['errors'],
+            100 * s['utilization'], s['queue_depth_mean'], s['queue_depth_max']))
+    print("Elapsed: %.2fs" % elapsed)
+
+
+def image_items(paths):
+    for path in paths:
+        yield {'name': os.path.splitext(os.path.basename(path))[0], 'path': path}
+
+
+def video_items(path, every=1):
+    # Frames are decoded here, on the thread feeding the pipeline, so for videos
+    # --decode-workers only covers the BGR->RGB copy into shared memory
+    import cv2
+    capture = cv2.VideoCapture(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    index = 0
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if index % every == 0:
+                yield {'name': '%s_%06d' % (name, index), 'frame': frame}
+            index += 1
+    finally:
+        capture.release()
+
+
+def _bake_image(img, landmarks, align, rigid_weight, vertex_colors, color_radius):
+    canonical_verts = load_canonical_model()[0]
+    H, W, _ = img.shape
+    vertices = align_vertices(landmarks_to_keypoints3d(landmarks, W, H), canonical_verts,
+                              align, rigid_weight)
+    pixels = landmarks_to_pixels(landmarks, W, H)
+    if vertex_colors:
+        return vertices, None, sample_vertex_colors(img, pixels, color_radius)
+    return vertices, bake_texture(img, pixels, load_uv_map()), None
+
+
+def _bake_shared(shm_name, shape, *options):
+    """Runs in a bake process: bakes the image held in the named shared memory block"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return _bake_image(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf), *options)
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass  # A traceback still references the image; closed when it's collected
+
+
+def _to_shared(img):
+    """Copies an image into a new shared memory block, returns (block, array view)"""
+    shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+    shared = np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)
+    shared[...] = img
+    return shm, shared
+
+
+def _release(item):
+    """Frees an item's shared memory image"""
+    shm = item.pop('shm', None)
+    item.pop('img', None)
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def build_stages(args, bake_pool):
+    """The converter's stages for the given command line options. Textures are
+    baked by bake_pool, a ProcessPoolExecutor"""
+    _local = threading.local()
+    _, uvcoords, faces, uv_faces = load_canonical_model()
+
+    def decode(item):
+        if 'frame' in item:
+            # OpenCV frames are BGR
+            img = item.pop('frame')[:, :, ::-1]
+        else:
+            img = load_image(item['path'])
+        item['shm'], item['img'] = _to_shared(img)
+        return item
+
+    def detect(item):
+        # One FaceMesh per detect worker thread
+        face_mesh = getattr(_local, 'face_mesh', None)
+        if face_mesh is None:
+            face_mesh = _local.face_mesh = create_face_mesh()
+        try:
+            item['landmarks'] = detect_landmarks(item['img'], face_mesh)
+        except NoFaceDetected:
+            _release(item)
+            return None  # Nothing to write; any other failure is recorded as a stage error
+        except Exception:
+            _release(item)
+            raise
+        return item
+
+    def bake(item):
+        # Waits on the bake process, which releases this thread's GIL
+        try:
+            vertices, texture, colors = bake_pool.submit(
+                _bake_shared, item['shm'].name, item['img'].shape, item['landmarks'],
+                args.align, args.rigid_weight, args.vertex_colors or args.format == 'ply',
+                args.color_radius).result()
+        finally:
+            # The image isn't needed any more, free it before the write stage
+            _release(item)
+        item['vertices'] = vertices
+        if colors is not None:
+            item['colors'] = colors
+        else:
+            item['texture'] = texture
+        return item
+
+    def write(item):
+        base = os.path.join(args.output, item['name'])
+        if args.format == 'ply':
+            write_ply(base + '.ply', item['vertices'], faces, item['colors'])
+        elif 'colors' in item:
+            write_obj(base + '.obj', item['vertices'], faces, colors=item['colors'])
+        else:
+            write_obj(base + '.obj', item['vertices'], faces, base + '_texture.jpg',
+                      texture=item['texture'], uvcoords=uvcoords, uvfaces=uv_faces)
+        return item
+
+    return [
+        Stage('decode', decode, args.decode_workers),
+        Stage('detect', detect, args.detect_workers),
+        Stage('bake', bake, args.bake_workers),
+        Stage('write', write, args.write_workers),
+    ]
+
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1"""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % value)
+    return n
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(prog="pipeline", description="Convert many images or video frames to 3D meshes")
+    parser.add_argument('-i', '--input', nargs='+', required=True,
+                        help="Images, directories of images, or a video file")
+    parser.add_argument('-o', '--output', default='results', help="Output directory")
+    parser.add_argument('-a', '--align', choices=['grid', 'procrustes'], default='grid')
+    parser.add_argument('--rigid-weight', type=float, default=DEFAULT_RIGID_WEIGHT,
+                        help="With -a procrustes: weight of the rigid landmarks (1 = unweighted)")
+    parser.add_argument('-f', '--format', choices=['obj', 'ply'], default='obj',
+                        help="Mesh format. 'ply' is binary and always uses vertex colours")
+    parser.add_argument('--vertex-colors', action='store_true',
+                        help="Colour the vertices from the image instead of baking a texture")
+    parser.add_argument('--color-radius', type=non_negative_int, default=0)
+    parser.add_argument('--every', type=positive_int, default=1, help="For videos, only convert every Nth frame")
+    parser.add_argument('--decode-workers', type=positive_int, default=4)
+    parser.add_argument('--detect-workers', type=positive_int, default=cores)
+    parser.add_argument('--bake-workers', type=positive_int, default=cores,
+                        help="Bake processes (and the threads feeding them)")
+    parser.add_argument('--write-workers', type=positive_int, default=4)
+    parser.add_argument('--queue-size', type=positive_int, default=8, help="Capacity of the queue in front of each stage")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    paths, videos = [], []
+    for entry in args.input:
+        if os.path.isdir(entry):
+            paths += sorted(p for p in glob.glob(os.path.join(entry, '*'))
+                            if p.lower().endswith(IMAGE_EXTENSIONS))
+        elif entry.lower().endswith(VIDEO_EXTENSIONS):
+            videos.append(entry)
+        else:
+            paths.append(entry)
+
+    def items():
+        yield from image_items(paths)
+        for video in videos:
+            yield from video_items(video, args.every)
+
+    # spawn rather than fork: the parent already runs threads
+    with ProcessPoolExecutor(args.bake_workers, mp_context=multiprocessing.get_context('spawn')) as bake_pool:
+        stages = build_stages(args, bake_pool)
+        pipeline = Pipeline(stages, queue_size=args.queue_size)
+        stats = pipeline.run(items())
+    print_stats(stats, pipeline.elapsed)
+    for stage in stages:
+        for name, error in stage.errors:
+            print("%s failed on %s: %s" % (stage.name, name, error), file=sys.stderr)
+    print('Process Complete!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Disk retention for the web app's uploads/ and results/ folders
+
+Files are grouped into artifacts (e.g. every file produced for one upload)
+and a background sweeper evicts whole artifacts, oldest first, once they are
+older than the folder's TTL or while the folder is over its byte quota.
+Folders can be linked, in which case an artifact spans all of them: the
+source image in uploads/ is only ever evicted together with its results.
+
+Artifacts that are pinned (being generated or served) are never evicted.
+Pins are flock()ed files under the state directory, so they are seen by every
+worker process of a multi-process server, and only one process at a time
+(the holder of the sweeper lock) runs the sweeps. Without fcntl (Windows),
+pins and the sweeper are per process and a single worker must be used.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_STATE_DIR = '.retention'
+
+
+class RetentionPolicy:
+
+    def __init__(self, folder, ttl_seconds=None, max_bytes=None, artifact_key=None, linked_folders=()):
+        self.folder = folder
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        # Maps a file name to the artifact it belongs to; files are their own artifact by default
+        self.artifact_key = artifact_key or (lambda name: name)
+        # Folders whose files with the same artifact key belong to the same artifact
+        self.linked_folders = tuple(linked_folders)
+
+
+class Retention:
+
+    def __init__(self, policies, interval=60.0, state_dir=DEFAULT_STATE_DIR):
+        self.policies = {policy.folder: policy for policy in policies}
+        self.interval = interval
+        self.state_dir = state_dir
+        self.pin_dir = os.path.join(state_dir, 'pins')
+        os.makedirs(self.pin_dir, exist_ok=True)
+        self._pins = {}  # Only used without fcntl
+        self._lock = threading.Lock()
+        self._leader_fd = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {folder: {'evicted_files': 0,
+                               'evicted_bytes': 0,
+                               'evicted_artifacts': 0,
+                               'skipped_pinned': 0,
+                               'bytes': 0,
+                               'files': 0}
+                      for folder in self.policies}
+        self.last_sweep = None
+
+    def _pin_path(self, folder, key):
+        name = hashlib.sha1(('%s\0%s' % (os.path.abspath(folder), key)).encode()).hexdigest()
+        return os.path.join(self.pin_dir, name + '.lock')
+
+    def _lock_pin_file(self, path, mode):
+        """Opens and flocks a pin file. Returns the fd, or None if mode is non-blocking and it is held"""
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, mode)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # The sweeper unlinks pin files of evicted artifacts; if that happened
+            # while we waited, our lock is on a dead file and we have to retry
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    @contextmanager
+    def pin(self, folder, key):
+        """Protects one artifact from eviction, in every process, while the block runs"""
+        if fcntl is None:
+            with self._lock:
+                self._pins[(folder, key)] = self._pins.get((folder, key), 0) + 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self._pins[(folder, key)] -= 1
+                    if self._pins[(folder, key)] == 0:
+                        del self._pins[(folder, key)]
+            return
+
+        fd = self._lock_pin_file(self._pin_path(folder, key), fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _exclusive(self, pins):
+        """Yields True, holding off new pins, if none of the (folder, key) pins are held"""
+        if fcntl is None:
+            with self._lock:
+                yield not any(pin in self._pins for pin in pins)
+            return
+
+        locked = []
+        try:
+            for folder, key in pins:
+                path = self._pin_path(folder, key)
+                fd = self._lock_pin_file(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if fd is None:
+                    yield False
+                    return
+                locked.append((path, fd))
+            yield True
+        finally:
+            for path, fd in locked:
+                # The artifact is gone (or never existed); drop its pin file
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                os.close(fd)
+
+    def _artifacts(self, policy):
+        """{key: [(folder, path, size, mtime), ...]} for every file in the folder"""
+        artifacts = {}
+        try:
+            entries = list(os.scandir(policy.folder))
+        except FileNotFoundError:
+            return artifacts
+        for entry in entries:
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            key = policy.artifact_key(entry.name)
+            artifacts.setdefault(key, []).append((policy.folder, entry.path, stat.st_size, stat.st_mtime))
+        return artifacts
+
+    def _evict(self, key, files):
+        """Deletes one artifact unless it is pinned or changed since it was listed.
+        Returns the bytes freed per folder"""
+        folders = sorted({f[0] for f in files})
+        freed = {}
+        with self._exclusive([(folder, key) for folder in folders]) as free:
+            if not free:
+                self.stats[files[0][0]]['skipped_pinned'] += 1
+                return freed
+            for _, path, _, mtime in files:
+                try:
+                    if os.stat(path).st_mtime != mtime:
+                        return freed
+                except FileNotFoundError:
+                    pass
+            for folder, path, size, _ in files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                stats = self.stats[folder]
+                stats['evicted_files'] += 1
+                stats['evicted_bytes'] += size
+                freed[folder] = freed.get(folder, 0) + size
+            self.stats[files[0][0]]['evicted_artifacts'] += 1
+        return freed
+
+    def sweep_folder(self, policy):
+        now = time.time()
+        artifacts = self._artifacts(policy)
+        total = sum(f[2] for files in artifacts.values() for f in files)
+        # Linked folders contribute the rest of each artifact's files
+        for folder in policy.linked_folders:
+            for key, files in self._artifacts(self.policies[folder]).items():
+                if key in artifacts:
+                    artifacts[key] = artifacts[key] + files
+        # Oldest first, by the most recent write to any of the artifact's files
+        ordered = sorted(artifacts.items(), key=lambda item: max(f[3] for f in item[1]))
+
+        for key, files in ordered:
+            newest = max(f[3] for f in files)
+            expired = policy.ttl_seconds is not None and now - newest > policy.ttl_seconds
+            over_quota = policy.max_bytes is not None and total > policy.max_bytes
+            if not expired and not over_quota:
+                # Everything after this is newer, and we're within the quota
+                break
+            total -= self._evict(key, files).get(policy.folder, 0)
+
+        stats = self.stats[policy.folder]
+        stats['bytes'] = total
+        stats['files'] = sum(len(files) for files in self._artifacts(policy).values())
+
+    def _clean_pins(self):
+        """Removes every pin file nobody holds. A pin file only matters while it
+        is locked and pin() recreates it on demand, so this keeps .retention/pins/
+        from growing with one file per name ever requested"""
+        if fcntl is None:
+            return
+        for name in os.listdir(self.pin_dir):
+            path = os.path.join(self.pin_dir, name)
+            try:
+                fd = self._lock_pin_file(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except FileNotFoundError:
+                continue
+            if fd is None:
+                continue  # Pinned
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def sweep(self):
+        for policy in self.policies.values():
+            self.sweep_folder(policy)
+        self._clean_pins()
+        self.last_sweep = time.time()
+        if fcntl is not None:
+            # Shared with the other worker processes through metrics()
+            tmp_path = os.path.join(self.state_dir, 'stats.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'last_sweep': self.last_sweep, 'stats': self.stats}, f)
+            os.replace(tmp_path, os.path.join(self.state_dir, 'stats.json'))
+
+    def _is_leader(self):
+        """Whether this process runs the sweeps; only one process holds the sweeper lock"""
+        if fcntl is None or self._leader_fd is not None:
+            return True
+        fd = os.open(os.path.join(self.state_dir, 'sweeper.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Held until the process exits, then another worker takes over
+        self._leader_fd = fd
+        return True
+
+    def _sweep_if_leader(self):
+        if self._is_leader():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"❌ Retention sweep failed: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sweep_if_leader()
+
+    def start(self):
+        """Sweeps now and then every interval seconds in a background thread,
+        as long as this is the process holding the sweeper lock"""
+        if self._thread is not None:
+            return
+        self._sweep_if_leader()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def metrics(self):
+        last_sweep, stats = self.last_sweep, self.stats
+        if fcntl is not None and self._leader_fd is None:
+            # Another process is sweeping; report what it last recorded
+            try:
+                with open(os.path.join(self.state_dir, 'stats.json')) as f:
+                    shared = json.load(f)
+                last_sweep, stats = shared['last_sweep'], shared['stats']
+            except (OSError, ValueError):
+                pass
+        return {
+            'last_sweep': last_sweep,
+            'folders': {folder: dict(stats.get(folder, {}),
+                                     ttl_seconds=policy.ttl_seconds,
+                                     max_bytes=policy.max_bytes)
+                        for folder, policy in self.policies.items()},
+        }
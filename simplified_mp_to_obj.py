@@ -2,10 +2,13 @@ import os
 import json
 import math
 import numpy as np
-import mediapipe as mp
 import skimage
 from skimage.transform import PiecewiseAffineTransform, warp
 import argparse
+import io
+from functools import lru_cache
+from collections import Counter
+from landmark_cache import LandmarkCache, DEFAULT_CACHE_DIR
 
 
 def load_obj(obj_filename):
@@ -66,14 +69,18 @@ def write_obj(obj_name,
               colors=None,
               texture=None,
               uvcoords=None,
-              uvfaces=None
+              uvfaces=None,
+              lazy_texture=False
               ):
+    # With lazy_texture the UV-mapped OBJ is written without a texture,
+    # and the MTL and texture are left to a later write_material() call
    
     if os.path.splitext(obj_name)[-1] != '.obj':
         obj_name = obj_name + '.obj'
     mtl_name = obj_name.replace('.obj', '.mtl')
     texture_name
     material_name = 'FaceTexture'
+    textured = texture is not None or lazy_texture
 
     faces = faces.copy()
     # mesh lab start with 1, python/c++ start from 0
@@ -82,7 +89,7 @@ def write_obj(obj_name,
     # write obj
     with open(obj_name, 'w') as f:
         # first line: write mtlib(material library)
-        if texture is not None:
+        if textured:
             f.write('mtllib %s\n\n' % os.path.basename(mtl_name))
 
         # write vertices
@@ -94,7 +101,7 @@ def write_obj(obj_name,
                 f.write('v {} {} {} {} {} {}\n'.format(vertices[i, 0], vertices[i, 1], vertices[i, 2], colors[i, 0], colors[i, 1], colors[i, 2]))
 
         # write uv coords
-        if texture is None:
+        if not textured:
             for i in range(faces.shape[0]):
                 f.write('f {} {} {}\n'.format(faces[i, 2], faces[i, 1], faces[i, 0]))
         else:
@@ -110,16 +117,29 @@ def write_obj(obj_name,
                     faces[i, 2], uvfaces[i, 2]
                 )
                 )
-            # write mtl
-            with open(mtl_name, 'w') as f:
-                f.write('newmtl %s\n' % material_name)
-                s = 'map_Kd {}\n'.format(os.path.basename(texture_name)) # map to image
-                f.write(s)
-            try:
-                skimage.io.imsave(texture_name, texture)
-            except Exception as e:
-                # There's still an alpha channel in the image
-                skimage.io.imsave(texture_name, skimage.color.rgba2rgb(texture))
+
+    if texture is not None:
+        write_material(mtl_name, texture_name, texture, material_name)
+
+def write_material(mtl_name, texture_name, texture, material_name='FaceTexture'):
+    # Both files are written under a temporary name and moved into place, so readers
+    # never see a partial file. The texture goes first, so an existing MTL always
+    # points at a complete image
+    base, ext = os.path.splitext(texture_name)
+    tmp_texture = base + '.tmp' + ext  # imsave picks the format from the extension
+    try:
+        skimage.io.imsave(tmp_texture, texture)
+    except Exception as e:
+        # There's still an alpha channel in the image
+        skimage.io.imsave(tmp_texture, skimage.color.rgba2rgb(texture))
+    os.replace(tmp_texture, texture_name)
+    # write mtl
+    tmp_mtl = mtl_name + '.tmp'
+    with open(tmp_mtl, 'w') as f:
+        f.write('newmtl %s\n' % material_name)
+        s = 'map_Kd {}\n'.format(os.path.basename(texture_name)) # map to image
+        f.write(s)
+    os.replace(tmp_mtl, mtl_name)
 
 def normalize_keypoints(keypoints3d):
     # Rotates and centers the points.
@@ -187,88 +207,324 @@ def rotate_around_origin(keypoints3d, opp_side, adj_side, angle):
 def unit_vector(vector):
     return vector / np.linalg.norm(vector)
 
-def main():
-    parser = argparse.ArgumentParser(prog="Mediapipe to OBJ", description="Covert 2D pictures to 3D meshes")
-    parser.add_argument('-i', '--input', required=False, help="The path for the face image")
-    parser.add_argument('-o', '--output', required=False, help="The output directory. Defaults to 'results/<name of image>.obj'")
-    args = parser.parse_args()
-
-    img_path = ''
-    if not 'input' in args or args.input == None:
-        img_path = input("Filename: ")
-    else:
-        img_path = args.input
-    img_ori = skimage.io.imread(img_path)
-    uv_path = "data/uv_map.json"
+# Landmarks that barely move with expression: forehead, nose bridge and tip, eye
+# corners and the sides of the face. The Procrustes fit weights them above the
+# jaw, lips and cheeks so that expressions don't tilt or rescale the head
+RIGID_LANDMARKS = [
+    10, 151, 9, 8, 109, 67, 103, 338, 297, 332, 69, 299, 108, 337,  # forehead
+    168, 6, 197, 195, 5, 4, 1, 19, 94,  # nose
+    33, 133, 362, 263,  # eye corners
+    234, 454, 127, 356, 162, 389, 21, 251,  # temples and sides of the face
+]
+DEFAULT_RIGID_WEIGHT = 10.0
+
+def procrustes_weights(rigid_weight=DEFAULT_RIGID_WEIGHT, n=468):
+    # Per-landmark weights for procrustes_align; rigid_weight=1 gives an unweighted fit
+    weights = np.ones(n)
+    weights[RIGID_LANDMARKS] = rigid_weight
+    return weights
+
+def procrustes_align(keypoints3d, canonical_verts, weights=None):
+    # Closed-form weighted similarity fit (Umeyama) of the detected landmarks onto
+    # the canonical face model. Works on one face (468, 3) or a batch (B, 468, 3);
+    # every face costs a single 3x3 SVD, all of them solved in one call.
+    # The result lives in the canonical model's metric frame (centimetres),
+    # so every face in a batch comes out with the same orientation and scale.
+    keypoints3d = np.asarray(keypoints3d, dtype=np.float64)
+    single = keypoints3d.ndim == 2
+    if single:
+        keypoints3d = keypoints3d[None]
+    canonical_verts = np.asarray(canonical_verts, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(canonical_verts.shape[0])
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights / weights.sum()
+
+    src_mean = np.einsum('n,bnd->bd', weights, keypoints3d)
+    dst_mean = weights.dot(canonical_verts)
+    src = keypoints3d - src_mean[:, None, :]
+    dst = canonical_verts - dst_mean
+
+    # Weighted cross-covariance between canonical (rows) and detected (cols) points
+    cov = np.einsum('n,ni,bnj->bij', weights, dst, src)
+    U, S, Vt = np.linalg.svd(cov)
+    # Flip the smallest singular direction when the fit would be a reflection
+    d = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    d[d == 0] = 1
+    S[:, 2] *= d
+    U[:, :, 2] *= d[:, None]
+    R = U @ Vt
+
+    src_var = np.einsum('n,bnd->b', weights, src ** 2)
+    scale = S.sum(axis=1) / src_var
+
+    aligned = scale[:, None, None] * np.einsum('bij,bnj->bni', R, src) + dst_mean
+    return aligned[0] if single else aligned
+
+def align_vertices(keypoints3d, canonical_verts, mode='grid', rigid_weight=DEFAULT_RIGID_WEIGHT):
+    # 'grid' is the original atan2-based alignment, 'procrustes' fits to the canonical
+    # model with the rigid landmarks weighted by rigid_weight
+    if mode == 'procrustes':
+        return procrustes_align(keypoints3d, canonical_verts, procrustes_weights(rigid_weight))
+    if mode == 'grid':
+        # keypoints3d already has a face that's more round than the original
+        vertices = normalize_keypoints(keypoints3d)
+        # Rotate the vertices so the face isn't at an odd angle
+        return align_keypoints_to_grid(vertices)
+    raise ValueError("Unknown alignment mode: %s" % mode)
+
+# Pipeline stages, shared by the CLI and the web app:
+# load_image -> detect_landmarks -> (bake_texture) -> align_vertices -> write_obj
+
+UV_MAP_PATH = "data/uv_map.json"
+CANONICAL_MODEL_PATH = "./data/canonical_face_model.obj"
+
+@lru_cache(maxsize=None)
+def load_uv_map(uv_path=UV_MAP_PATH):
     uv_map_dict = json.load(open(uv_path))
-    uv_map = np.array([ (uv_map_dict["u"][str(i)],uv_map_dict["v"][str(i)]) for i in range(468)])
-
-    img = img_ori
-    H,W,_ = img.shape
-    # run facial landmark detection
-    with mp.solutions.face_mesh.FaceMesh(
-            static_image_mode=True,
-            refine_landmarks=True,
-            max_num_faces=1,
-            min_detection_confidence=0.5) as face_mesh:
-        try:
+    return np.array([(uv_map_dict["u"][str(i)], uv_map_dict["v"][str(i)]) for i in range(468)])
+
+@lru_cache(maxsize=None)
+def load_canonical_model(obj_filename=CANONICAL_MODEL_PATH):
+    # Cached, so callers must not modify the returned arrays in place
+    return load_obj(obj_filename)
+
+def load_image(img_path):
+    # Reads a path or file-like object as an 8-bit RGB image, which is what
+    # MediaPipe expects (PNGs with an alpha channel and grayscale images are converted)
+    img = skimage.io.imread(img_path)
+    if img.ndim == 2:
+        img = skimage.color.gray2rgb(img)
+    elif img.shape[2] == 4:
+        img = (skimage.color.rgba2rgb(img) * 255).astype(np.uint8)
+    return img
+
+# Settings of the FaceMesh detector, also part of the landmark cache key
+DETECTOR_PARAMS = {
+    'static_image_mode': True,
+    'refine_landmarks': True,
+    'max_num_faces': 1,
+    'min_detection_confidence': 0.5,
+}
+
+class NoFaceDetected(Exception):
+    pass
+
+def create_face_mesh():
+    # MediaPipe is imported here rather than at the top, so the paths that start
+    # from cached or precomputed landmarks never load it
+    import mediapipe as mp
+    return mp.solutions.face_mesh.FaceMesh(**DETECTOR_PARAMS)
+
+def detect_landmarks(img, face_mesh=None):
+    # Returns the normalized (x, y, z) landmarks of the first face, shape (478, 3)
+    # with refine_landmarks (468 face points followed by the iris points)
+    if face_mesh is None:
+        with create_face_mesh() as face_mesh:
             results = face_mesh.process(img)
-        except ValueError as e:
-            # PNG was probaly provided, try to convert to JPG
-            try:
-                tmp_path = 'converted.jpg'
-                png_img = skimage.io.imread(img_path)
-                rgb_img = skimage.color.rgba2rgb(png_img)
-                skimage.io.imsave(tmp_path, rgb_img, quality=100)
-                img = skimage.io.imread(tmp_path)
-                # TODO: Delete the converted
-                results = face_mesh.process(img)
-                
-            except:
-                raise Exception('Unable to use a PNG, and unable to automatically convert PNG to JPG')
-
-    assert len(results.multi_face_landmarks)==1 
+    else:
+        results = face_mesh.process(img)
+
+    if not results.multi_face_landmarks:
+        raise NoFaceDetected("No face detected in the image.")
 
     face_landmarks = results.multi_face_landmarks[0]
-    keypoints = np.array([(W*point.x,H*point.y) for point in face_landmarks.landmark[0:468]])#after 468 is iris or something else
+    return np.array([(point.x, point.y, point.z) for point in face_landmarks.landmark])
+
+def detect_landmarks_cached(img_path, cache=None, refresh=False):
+    # detect_landmarks for an image file, reusing a previous detection from the
+    # cache when the file content and detector settings match.
+    # Returns (landmarks, (H, W), img); img is None on a cache hit, so callers
+    # that need the pixels (texture, vertex colours) decode it with load_image
+    with open(img_path, 'rb') as f:
+        data = f.read()
+    key = None
+    if cache is not None:
+        key = LandmarkCache.key(data, DETECTOR_PARAMS)
+        if refresh:
+            cache.invalidate(key)
+        else:
+            hit = cache.get(key)
+            if hit is not None:
+                landmarks, size = hit
+                return landmarks, size, None
+
+    img = load_image(io.BytesIO(data))
+    landmarks = detect_landmarks(img)
+    if cache is not None:
+        cache.put(key, landmarks, img.shape[:2], DETECTOR_PARAMS)
+    return landmarks, img.shape[:2], img
+
+def image_size(img_path):
+    # (H, W) of an image file without decoding its pixels
+    from PIL import Image
+    with Image.open(img_path) as im:
+        return im.height, im.width
+
+def load_landmarks(path):
+    # Reads precomputed normalized MediaPipe landmarks as an (N, 468|478, 3) array.
+    # .npy: (K, 3) or (N, K, 3). .json: the same nested lists, optionally under a
+    # "landmarks" key. .csv: K rows of x,y,z for one face, or one row of K*3
+    # values per face
+    ext = os.path.splitext(path)[-1].lower()
+    if ext == '.npy':
+        data = np.load(path)
+    elif ext == '.json':
+        data = json.load(open(path))
+        if isinstance(data, dict):
+            data = data['landmarks']
+        data = np.array(data, dtype=np.float64)
+    elif ext == '.csv':
+        data = np.loadtxt(path, delimiter=',', ndmin=2)
+        if data.shape[1] != 3:
+            data = data.reshape(data.shape[0], -1, 3)
+    else:
+        raise ValueError("Unsupported landmark file: %s" % path)
 
-    # TODO: Debugging - Save a copy of the image with the points over it
+    if data.ndim == 2:
+        data = data[None]
+    if data.ndim != 3 or data.shape[1] not in (468, 478) or data.shape[2] != 3:
+        raise ValueError("Expected landmarks of shape (468|478, 3) or (N, 468|478, 3), got %s" % (data.shape,))
+    return data.astype(np.float64)
 
-    H_new,W_new = 512,512
-    keypoints_uv = np.array([(W_new*x, H_new*y) for x,y in uv_map])
+def landmarks_to_pixels(landmarks, W, H):
+    # after 468 is iris or something else
+    return landmarks[:468, :2] * np.array([W, H])
 
-    tform = PiecewiseAffineTransform()
-    tform.estimate(keypoints_uv,keypoints)
-    texture = warp(img_ori, tform, output_shape=(H_new,W_new))
-    texture = (255*texture).astype(np.uint8)
-    
+def landmarks_to_keypoints3d(landmarks, W, H):
     # The X, Y, and Z coords are normalized to 0.0 to 1.0 for the width and height of the image (Z is at the same scale as X).
     # To restore the face to it's original ratio, the X and Z coordinates need to be scaled by the ratio of width to height
     # See https://google.github.io/mediapipe/solutions/face_mesh#output for more details
-
     width_ratio = W / H
-    keypoints3d = np.array([(width_ratio * point.x, point.y, width_ratio * point.z) for point in face_landmarks.landmark[0:468]]) 
+    return landmarks[:468] * np.array([width_ratio, 1.0, width_ratio])
 
-    obj_filename = "./data/canonical_face_model.obj"
-    canonical_verts,uvcoords,faces,uv_faces = load_obj(obj_filename)
+def bake_texture(img, keypoints, uv_map, size=512):
+    # Warps the face in the image into the UV layout of the canonical model
+    H_new, W_new = size, size
+    keypoints_uv = uv_map * np.array([W_new, H_new])
 
-    # keypoints3d already has a face that's more round than the original
-    vertices = normalize_keypoints(keypoints3d)
-    # Rotate the vertices so the face isn't at an odd angle
-    vertices = align_keypoints_to_grid(vertices)
-    
-    filename =  os.path.splitext(os.path.basename(img_path))[0] # the name without the extension
-    obj_name =  "./results/%s.obj" % filename
-    texture_name = "./results/%s_texture.jpg" % filename
-    if 'output' in args and args.output != None:
-        output_filename = os.path.splitext(args.output)[0]
-        obj_name = '%s.obj' % output_filename
-        texture_name = '%s_texture.jpg' % output_filename
-
-    save_dir = os.path.split(obj_name)[0]
-    if not os.path.isdir(save_dir):
+    tform = PiecewiseAffineTransform()
+    tform.estimate(keypoints_uv, keypoints)
+    texture = warp(img, tform, output_shape=(H_new, W_new))
+    return (255*texture).astype(np.uint8)
+
+def sample_vertex_colors(img, keypoints, radius=0):
+    # Bilinear sampling of the image at the (x, y) pixel position of every vertex,
+    # averaged over a (2*radius+1)^2 pixel neighbourhood. Returns RGB in [0, 1], shape (N, 3)
+    if radius < 0:
+        raise ValueError("radius must be >= 0, got %r" % radius)
+    H, W = img.shape[:2]
+    steps = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(steps, steps), axis=-1).reshape(-1, 2)
+    points = keypoints[:, None, :2] + offsets[None]  # (N, K, 2)
+    x = np.clip(points[..., 0], 0, W - 1)
+    y = np.clip(points[..., 1], 0, H - 1)
+
+    x0 = np.floor(x).astype(int)
+    y0 = np.floor(y).astype(int)
+    x1 = np.minimum(x0 + 1, W - 1)
+    y1 = np.minimum(y0 + 1, H - 1)
+    wx = (x - x0)[..., None]
+    wy = (y - y0)[..., None]
+
+    img = img.astype(np.float64)
+    top = img[y0, x0] * (1 - wx) + img[y0, x1] * wx
+    bottom = img[y1, x0] * (1 - wx) + img[y1, x1] * wx
+    colors = (top * (1 - wy) + bottom * wy).mean(axis=1)
+    return colors[:, :3] / 255.0
+
+def write_ply(ply_name, vertices, faces, colors=None):
+    # Binary little-endian PLY, with 8-bit per-vertex colours when given.
+    # Faces keep the same winding as write_obj's untextured output
+    if os.path.splitext(ply_name)[-1] != '.ply':
+        ply_name = ply_name + '.ply'
+
+    vertex_dtype = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        vertex_dtype += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertex_data = np.empty(vertices.shape[0], dtype=vertex_dtype)
+    vertex_data['x'], vertex_data['y'], vertex_data['z'] = vertices.T
+    if colors is not None:
+        rgb = np.clip(np.round(colors * 255), 0, 255).astype(np.uint8)
+        vertex_data['red'], vertex_data['green'], vertex_data['blue'] = rgb.T
+
+    face_data = np.empty(faces.shape[0], dtype=[('n', 'u1'), ('indices', '<i4', (3,))])
+    face_data['n'] = 3
+    face_data['indices'] = faces[:, [2, 1, 0]]
+
+    header = ['ply', 'format binary_little_endian 1.0',
+              'element vertex %d' % vertices.shape[0],
+              'property float x', 'property float y', 'property float z']
+    if colors is not None:
+        header += ['property uchar red', 'property uchar green', 'property uchar blue']
+    header += ['element face %d' % faces.shape[0],
+               'property list uchar int vertex_indices',
+               'end_header']
+    with open(ply_name, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(vertex_data.tobytes())
+        f.write(face_data.tobytes())
+
+LANDMARK_FORMATS = {
+    'json': ('.json', 'application/json'),
+    'npy': ('.npy', 'application/octet-stream'),
+    'f32': ('.f32', 'application/octet-stream'),
+}
+
+def encode_landmarks(raw, aligned, fmt='json'):
+    # raw: MediaPipe's normalized landmarks, aligned: the aligned mesh vertices, both (468, 3).
+    # 'npy' and 'f32' hold both as one (2, 468, 3) little-endian float32 array,
+    # 'f32' being the bare bytes without the NPY header.
+    if fmt == 'json':
+        return json.dumps({'raw': raw[:468].tolist(), 'aligned': aligned.tolist()}).encode()
+    stacked = np.stack([raw[:468], aligned]).astype('<f4')
+    if fmt == 'npy':
+        buf = io.BytesIO()
+        np.save(buf, stacked)
+        return buf.getvalue()
+    if fmt == 'f32':
+        return stacked.tobytes()
+    raise ValueError("Unknown landmark format: %s" % fmt)
+
+def export_face(output_filename, landmarks, vertices, args, H, W, img=None, img_path=None):
+    # Writes one face in the format selected on the command line. The image is only
+    # needed (and decoded from img_path if not given) for the texture or vertex colours
+    save_dir = os.path.split(output_filename)[0]
+    if save_dir and not os.path.isdir(save_dir):
         os.makedirs(save_dir)
 
+    if args.landmarks_only:
+        ext, _ = LANDMARK_FORMATS[args.landmarks_format]
+        with open('%s_landmarks%s' % (output_filename, ext), 'wb') as f:
+            f.write(encode_landmarks(landmarks, vertices, args.landmarks_format))
+        return
+
+    canonical_verts,uvcoords,faces,uv_faces = load_canonical_model()
+    if img is None and img_path is not None:
+        img = load_image(img_path)
+
+    if img is None:
+        # Precomputed landmarks without a source image: geometry only
+        if args.format == 'ply':
+            write_ply('%s.ply' % output_filename, vertices, faces)
+        else:
+            write_obj('%s.obj' % output_filename, vertices, faces)
+        return
+
+    if args.vertex_colors or args.format == 'ply':
+        # Texture-free path: colours are sampled at the landmark pixels
+        colors = sample_vertex_colors(img, landmarks_to_pixels(landmarks, W, H), args.color_radius)
+        if args.format == 'ply':
+            write_ply('%s.ply' % output_filename, vertices, faces, colors)
+        else:
+            write_obj('%s.obj' % output_filename, vertices, faces, colors=colors)
+        return
+
+    # TODO: Debugging - Save a copy of the image with the points over it
+    texture = bake_texture(img, landmarks_to_pixels(landmarks, W, H), load_uv_map())
+
+    obj_name = '%s.obj' % output_filename
+    texture_name = '%s_texture.jpg' % output_filename
     write_obj(obj_name,
                 vertices,
                 faces,
@@ -277,8 +533,152 @@ def main():
                 uvcoords=uvcoords,
                 uvfaces=uv_faces,
                 )
+
+def convert_landmarks(args):
+    # Detector-free path: drives alignment and export from stored landmarks.
+    # MediaPipe is never imported here
+    batch = load_landmarks(args.landmarks)
+    images = args.source_images or []
+    if len(images) not in (0, 1, len(batch)):
+        raise ValueError("Got %d source images for %d landmark sets" % (len(images), len(batch)))
+
+    # Source image of each landmark set, if any
+    face_images = [None] * len(batch)
+    if images:
+        face_images = images if len(images) > 1 else images * len(batch)
+
+    # Image sizes give the aspect ratio of the normalized coordinates;
+    # each distinct image is only opened once
+    sizes = []
+    image_sizes = {}
+    for img_path in face_images:
+        if img_path is not None:
+            if img_path not in image_sizes:
+                image_sizes[img_path] = image_size(img_path)
+            sizes.append(image_sizes[img_path])
+        elif args.image_size:
+            W, H = args.image_size
+            sizes.append((H, W))
+        else:
+            sizes.append((1, 1))
+
+    canonical_verts = load_canonical_model()[0]
+    keypoints3d = np.stack([landmarks_to_keypoints3d(landmarks, W, H)
+                            for landmarks, (H, W) in zip(batch, sizes)])
+    if args.align == 'procrustes':
+        # One batched solve for the whole archive
+        vertices = procrustes_align(keypoints3d, canonical_verts, procrustes_weights(args.rigid_weight))
+    else:
+        vertices = [align_vertices(k, canonical_verts, args.align) for k in keypoints3d]
+
+    output_filename = "./results/%s" % os.path.splitext(os.path.basename(args.landmarks))[0]
+    if 'output' in args and args.output != None:
+        output_filename = os.path.splitext(args.output)[0]
+
+    # Images shared by several landmark sets are decoded once and kept,
+    # the others are decoded by export_face when (and if) it needs the pixels
+    uses = Counter(face_images)
+    shared = {path for path, n in uses.items() if path is not None and n > 1}
+    decoded = {}
+    for i in range(len(batch)):
+        name = output_filename if len(batch) == 1 else '%s_%04d' % (output_filename, i)
+        img_path = face_images[i]
+        img = None
+        if img_path in shared and not args.landmarks_only:
+            if img_path not in decoded:
+                decoded[img_path] = load_image(img_path)
+            img = decoded[img_path]
+        H, W = sizes[i]
+        export_face(name, batch[i], vertices[i], args, H, W, img=img, img_path=img_path)
+
+def non_negative_int(value):
+    # argparse type for sizes that can't be negative
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError("must be >= 0, got %s" % value)
+    return n
+
+def image_size_arg(value):
+    # argparse type for WIDTHxHEIGHT, returns (W, H)
+    try:
+        W, H = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, e.g. 640x480, got %r" % value)
+    if W < 1 or H < 1:
+        raise argparse.ArgumentTypeError("width and height must be at least 1, got %r" % value)
+    return W, H
+
+def main():
+    parser = argparse.ArgumentParser(prog="Mediapipe to OBJ", description="Covert 2D pictures to 3D meshes")
+    parser.add_argument('-i', '--input', required=False, help="The path for the face image")
+    parser.add_argument('-o', '--output', required=False, help="The output directory. Defaults to 'results/<name of image>.obj'")
+    parser.add_argument('-l', '--landmarks', required=False,
+                        help="Use precomputed MediaPipe landmarks (NPY/JSON/CSV, (468|478, 3) or (N, 468|478, 3)) "
+                             "instead of running detection on an image")
+    parser.add_argument('--source-images', nargs='+',
+                        help="With --landmarks: the image(s) the landmarks came from, for texturing. "
+                             "One per landmark set, or a single one for all")
+    parser.add_argument('--image-size', type=image_size_arg, help="With --landmarks and no source images: WIDTHxHEIGHT of the "
+                                             "original images, used for the aspect ratio. Defaults to square")
+    parser.add_argument('-a', '--align', choices=['grid', 'procrustes'], default='grid',
+                        help="How to orient the mesh: 'grid' rotates on individual landmarks, "
+                             "'procrustes' fits the canonical face model (metric scale)")
+    parser.add_argument('--rigid-weight', type=float, default=DEFAULT_RIGID_WEIGHT,
+                        help="With -a procrustes: weight of the forehead, nose and eye-corner landmarks "
+                             "relative to the rest (1 = unweighted fit)")
+    parser.add_argument('--landmarks-only', action='store_true',
+                        help="Only write the raw and aligned vertices, skipping the texture, MTL and OBJ")
+    parser.add_argument('--landmarks-format', choices=sorted(LANDMARK_FORMATS), default='json',
+                        help="File format for --landmarks-only. npy/f32 hold a (2, 468, 3) float32 array of raw and aligned vertices")
+    parser.add_argument('-f', '--format', choices=['obj', 'ply'], default='obj',
+                        help="Mesh format. 'ply' is binary and always uses vertex colours")
+    parser.add_argument('--vertex-colors', action='store_true',
+                        help="Colour the vertices from the image instead of baking a texture")
+    parser.add_argument('--color-radius', type=non_negative_int, default=0,
+                        help="Average vertex colours over a (2r+1)x(2r+1) pixel neighbourhood")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="Where detected landmarks are cached for later runs on the same image")
+    parser.add_argument('--no-cache', action='store_true', help="Always run detection and don't cache it")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help="Ignore and replace the cached landmarks of this image")
+    parser.add_argument('--clear-cache', action='store_true', help="Delete every cached detection first")
+    parser.add_argument('--cache-max-entries', type=int, default=1000, help="Maximum number of cached images")
+    parser.add_argument('--cache-max-mb', type=float, default=64, help="Maximum total size of the cache")
+    args = parser.parse_args()
+
+    if args.landmarks is not None:
+        convert_landmarks(args)
+        print('Process Complete!')
+        return
+
+    img_path = ''
+    if not 'input' in args or args.input == None:
+        img_path = input("Filename: ")
+    else:
+        img_path = args.input
+    cache = None
+    if not args.no_cache:
+        cache = LandmarkCache(args.cache_dir, args.cache_max_entries, int(args.cache_max_mb * 1024 * 1024))
+        if args.clear_cache:
+            cache.clear()
+        else:
+            cache.trim()
+
+    # run facial landmark detection (or reuse a cached one)
+    landmarks, (H, W), img = detect_landmarks_cached(img_path, cache, refresh=args.refresh_cache)
+    assert landmarks.shape[0] >= 468
+
+    canonical_verts = load_canonical_model()[0]
+    vertices = align_vertices(landmarks_to_keypoints3d(landmarks, W, H), canonical_verts, args.align, args.rigid_weight)
+
+    filename =  os.path.splitext(os.path.basename(img_path))[0] # the name without the extension
+    output_filename = "./results/%s" % filename
+    if 'output' in args and args.output != None:
+        output_filename = os.path.splitext(args.output)[0]
+
+    export_face(output_filename, landmarks, vertices, args, H, W, img=img, img_path=img_path)
     
     print('Process Complete!')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,41 @@
+import os
+
+from retention import Retention, RetentionPolicy
+
+
+def make_retention(tmp_path):
+    uploads, results = tmp_path / 'uploads', tmp_path / 'results'
+    uploads.mkdir()
+    results.mkdir()
+    return Retention([
+        RetentionPolicy(str(uploads), ttl_seconds=3600, linked_folders=[str(results)]),
+        RetentionPolicy(str(results), ttl_seconds=3600, linked_folders=[str(uploads)]),
+    ], state_dir=str(tmp_path / '.retention'))
+
+
+def test_sweep_removes_unheld_pin_files(tmp_path):
+    retention = make_retention(tmp_path)
+    for n in range(50):
+        with retention.pin(str(tmp_path / 'results'), 'missing%d' % n):
+            pass
+    with retention.pin(str(tmp_path / 'results'), 'held'):
+        retention.sweep()
+        # Only the pin that is still held survives
+        assert len(os.listdir(retention.pin_dir)) == 1
+    retention.sweep()
+    assert os.listdir(retention.pin_dir) == []
+
+
+def test_pin_still_works_after_its_file_was_cleaned(tmp_path):
+    retention = make_retention(tmp_path)
+    results = tmp_path / 'results'
+    (results / 'a').write_text('x')
+    os.utime(results / 'a', (0, 0))
+    with retention.pin(str(results), 'a'):
+        pass
+    retention._clean_pins()
+    with retention.pin(str(results), 'a'):
+        retention.sweep()
+        assert (results / 'a').exists()
+    retention.sweep()
+    assert not (results / 'a').exists()
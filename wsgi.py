@@ -0,0 +1,17 @@
+"""
+WSGI entry point for production servers, e.g.
+
+    gunicorn -w 2 --threads 4 -b 0.0.0.0:8080 wsgi:app
+
+Warmup and the retention sweeper start as soon as a worker imports this
+module; point the readiness probe at /readyz so traffic only arrives once
+warmup has finished. Every worker starts a sweeper thread, but only the one
+holding .retention/sweeper.lock sweeps, and pins are lock files under
+.retention/pins/ so they hold across workers. Without fcntl (Windows) run a
+single worker.
+"""
+
+from app import app, start_warmup, retention
+
+start_warmup()
+retention.start()